@@ -1,10 +1,16 @@
+import asyncio
 import csv
+import functools
+import hashlib
 import os
 import json
+import sqlite3
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
-from typing import List, Dict
+from typing import AsyncIterator, Iterator, List, Dict, Tuple, TypedDict
 
 try:
     import ollama  # type: ignore
@@ -12,6 +18,312 @@ except Exception as exc:
     raise SystemExit(
         "Missing dependency 'ollama'. Install with: pip install ollama"
     ) from exc
+import httpx  # dependency của ollama
+
+try:
+    import orjson  # type: ignore
+
+    _loads = orjson.loads  # nhanh hơn json.loads, nhận cả str lẫn bytes
+except ImportError:
+    _loads = json.loads
+
+try:
+    import numpy as np  # type: ignore
+except ImportError:  # chỉ cần cho --semantic-cache
+    np = None  # type: ignore
+
+_OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://127.0.0.1:11434")
+
+
+def _client_limits(workers: int) -> httpx.Limits:
+    return httpx.Limits(max_connections=workers * 2, max_keepalive_connections=workers * 2)
+
+
+# Client dùng chung (keep-alive) để không phải mở kết nối TCP mới cho mỗi lượt gọi
+_CLIENT_LIMITS = _client_limits(1)
+_CLIENT = ollama.Client(host=_OLLAMA_HOST, limits=_CLIENT_LIMITS)
+
+
+def configure_client(workers: int) -> None:
+    global _CLIENT, _CLIENT_LIMITS
+    _CLIENT_LIMITS = _client_limits(max(1, workers))
+    _CLIENT = ollama.Client(host=_OLLAMA_HOST, limits=_CLIENT_LIMITS)
+
+
+def _new_async_client() -> "ollama.AsyncClient":
+    # httpx.AsyncClient gắn với event loop đang chạy nên tạo mới cho mỗi lần asyncio.run
+    return ollama.AsyncClient(host=_OLLAMA_HOST, limits=_CLIENT_LIMITS)
+
+
+_ERROR_PREFIX = "[Lỗi gọi mô hình"
+
+# Giữ model (và KV-cache của prefix chung) trong bộ nhớ giữa các lượt gọi,
+# tránh Ollama unload rồi mất vài giây nạp lại sau những lần nghỉ --sleep
+_KEEP_ALIVE = "1h"
+_KEEP_ALIVE_REFRESH = 30 * 60  # giây
+
+
+def warmup(model_name: str, system_prompt: str, options: Dict[str, object] | None = None) -> None:
+    # Nạp sẵn model và prefix chung; dùng cùng options (num_ctx) với lượt
+    # chạy thật để Ollama không phải nạp lại model. Lỗi warmup được bỏ qua.
+    try:
+        _CLIENT.chat(
+            model=model_name,
+            messages=[{"role": "system", "content": system_prompt}],
+            options={**(options or {}), "num_predict": 1},
+            keep_alive=_KEEP_ALIVE,
+        )
+    except Exception:
+        pass
+
+
+def sleep_warm(seconds: float, model_name: str, system_prompt: str, options: Dict[str, object] | None) -> None:
+    # Ngủ theo từng đoạn và làm mới keep_alive để model không bị unload khi --sleep dài
+    while seconds > _KEEP_ALIVE_REFRESH:
+        time.sleep(_KEEP_ALIVE_REFRESH)
+        seconds -= _KEEP_ALIVE_REFRESH
+        warmup(model_name, system_prompt, options)
+    time.sleep(seconds)
+
+
+class TokenBucket:
+    # Giới hạn tốc độ phía client (rate yêu cầu/giây, dồn tối đa capacity) để
+    # không bắn cả loạt yêu cầu vào server Ollama dùng chung rồi bị 429
+    def __init__(self, rate: float, capacity: int) -> None:
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self._tokens = float(self.capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        # Lấy trước 1 token (có thể âm) và trả về số giây cần chờ
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def release(self) -> None:
+        # Trả lại token đã lấy trước nhưng không dùng (vd. lượt gọi trúng cache)
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + 1)
+
+    def acquire(self) -> None:
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self) -> None:
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+_BUCKET: TokenBucket | None = None
+
+
+def configure_rate_limit(rps: float, workers: int) -> None:
+    global _BUCKET
+    _BUCKET = TokenBucket(rate=rps, capacity=workers) if rps > 0 else None
+
+
+class ResponseCache:
+    # Cache khớp tuyệt đối (SQLite) cho các lượt gọi tất định
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            # WAL + synchronous=NORMAL: commit từng câu trả lời không fsync, chỉ
+            # fsync lúc checkpoint; WAL cũng cho nhiều tiến trình đọc khi đang ghi
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, content TEXT)")
+            self._conn.commit()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            row = self._conn.execute("SELECT content FROM cache WHERE key = ?", (key,)).fetchone()
+            self.stats["hits" if row else "misses"] += 1
+        return row[0] if row else None
+
+    def put(self, key: str, content: str) -> None:
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO cache (key, content) VALUES (?, ?)", (key, content))
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+_CACHE: ResponseCache | None = None
+
+
+def open_cache(path: str) -> ResponseCache:
+    global _CACHE
+    _CACHE = ResponseCache(path)
+    return _CACHE
+
+
+def _is_deterministic(options: Dict[str, object]) -> bool:
+    # Chỉ cache khi kết quả tái lập được: temperature=0 hoặc có seed cố định
+    return options.get("temperature") == 0 or bool(options.get("seed"))
+
+
+def _cache_key(
+    model_name: str, system_prompt: str, question: str, options: Dict[str, object], fmt: str = ""
+) -> str:
+    blob = json.dumps([model_name, system_prompt, question, options, fmt], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def _cache_lookup(
+    model_name: str, system_msg: Dict[str, str] | None, question: str, options: Dict[str, object] | None, fmt: str = ""
+) -> Tuple[str | None, str | None]:
+    # Trả về (key, nội dung đã cache); key là None khi lượt gọi không được cache
+    opts = options or {}
+    if _CACHE is None or not _is_deterministic(opts):
+        return None, None
+    system_prompt = system_msg["content"] if system_msg is not None else ""
+    key = _cache_key(model_name, system_prompt, question, opts, fmt)
+    try:
+        cached = _CACHE.get(key)
+    except sqlite3.Error:
+        return key, None
+    # Bản JSON hỏng do phiên bản cũ lưu vào coi như miss để retry gọi lại model
+    return key, cached if cached is None or _cacheable(cached, fmt) else None
+
+
+def _cacheable(content: str, fmt: str) -> bool:
+    # Với format="json" chỉ cache câu trả lời parse được: nếu lưu bản bị cắt
+    # giữa chừng thì mọi lượt --retries sau đều nhận lại đúng bản hỏng đó
+    if fmt != "json":
+        return True
+    try:
+        _load_json(content)
+    except Exception:
+        return False
+    return True
+
+
+def _cache_store(key: str | None, content: str, fmt: str = "") -> str:
+    # Lỗi cache (vd. "database is locked" khi nhiều tiến trình cùng ghi một
+    # file SQLite) được bỏ qua để không biến câu trả lời hợp lệ thành dòng lỗi
+    if key is not None and content and _cacheable(content, fmt):
+        try:
+            _CACHE.put(key, content)  # type: ignore[union-attr]
+        except sqlite3.Error:
+            pass
+    return content
+
+
+def embed_batch(texts: List[str], model_name: str = "nomic-embed-text") -> "np.ndarray":
+    # Một lượt /api/embed cho cả danh sách thay vì mỗi câu một request
+    response = _CLIENT.embed(model=model_name, input=texts)
+    return np.asarray(response["embeddings"], dtype=np.float32)
+
+
+class SemanticCache:
+    # Câu hỏi gần trùng nghĩa (cosine > threshold) dùng lại payload JSON chưa
+    # render đã có; nơi dùng phải gán lại "question" bằng câu hỏi hiện tại
+    def __init__(self, embed_model: str = "nomic-embed-text", threshold: float = 0.92) -> None:
+        if np is None:
+            raise SystemExit("Missing dependency 'numpy'. Install with: pip install numpy")
+        self.embed_model = embed_model
+        self.threshold = threshold
+        self._E: "np.ndarray | None" = None  # (capacity, D) float32
+        self._norms: "np.ndarray | None" = None
+        self._answers: List["Payload"] = []
+        self.stats = {"hits": 0, "misses": 0}
+
+    def embed_many(self, texts: List[str]) -> List["np.ndarray | None"]:
+        # Embedding None khi gọi embed lỗi: câu đó đi thẳng tới model, không cache
+        if not texts:
+            return []
+        try:
+            return list(embed_batch(texts, self.embed_model))
+        except Exception:
+            return [None] * len(texts)
+
+    async def embed_many_async(
+        self, client: "ollama.AsyncClient", texts: List[str]
+    ) -> List["np.ndarray | None"]:
+        if not texts:
+            return []
+        try:
+            response = await client.embed(model=self.embed_model, input=texts)
+            return list(np.asarray(response["embeddings"], dtype=np.float32))
+        except Exception:
+            return [None] * len(texts)
+
+    def match(self, embedding: "np.ndarray") -> "Payload | None":
+        n = len(self._answers)
+        hit = None
+        if n:
+            norm = max(float(np.linalg.norm(embedding)), 1e-12)
+            sims = (self._E[:n] @ embedding) / (self._norms[:n] * norm)  # type: ignore[index]
+            best = int(sims.argmax())
+            if sims[best] > self.threshold:
+                hit = self._answers[best]
+        self.stats["hits" if hit is not None else "misses"] += 1
+        return hit
+
+    def lookup_many(self, texts: List[str]) -> List[Tuple["np.ndarray | None", "Payload | None"]]:
+        # Trả về (embedding, payload cache) cho từng câu
+        return [(e, self.match(e) if e is not None else None) for e in self.embed_many(texts)]
+
+    def add(self, embedding: "np.ndarray", answer: "Payload") -> None:
+        n = len(self._answers)
+        if self._E is None:
+            self._E = np.zeros((16, embedding.shape[0]), dtype=np.float32)
+            self._norms = np.zeros(16, dtype=np.float32)
+        elif n == self._E.shape[0]:
+            self._E = np.concatenate([self._E, np.zeros_like(self._E)])
+            self._norms = np.concatenate([self._norms, np.zeros_like(self._norms)])  # type: ignore[list-item]
+        self._E[n] = embedding
+        self._norms[n] = max(float(np.linalg.norm(embedding)), 1e-12)  # type: ignore[index]
+        self._answers.append(answer)
+
+
+class CsvSink:
+    # Ghi CSV qua bộ đệm lớn, chỉ flush + fsync sau mỗi sync_rows dòng hoặc
+    # sync_seconds giây (0 = tắt điều kiện đó) thay vì fsync từng dòng
+    def __init__(self, f, sync_rows: int = 64, sync_seconds: float = 0.0) -> None:
+        self._f = f
+        self._writer = csv.writer(f)
+        self.sync_rows = sync_rows
+        self.sync_seconds = sync_seconds
+        self._rows_since_sync = 0
+        self._last_sync = time.monotonic()
+
+    def writerow(self, row: List[str]) -> None:
+        self.writerows([row])
+
+    def writerows(self, rows: List[List[str]]) -> None:
+        self._writer.writerows(rows)
+        self._rows_since_sync += len(rows)
+        if (self.sync_rows and self._rows_since_sync >= self.sync_rows) or (
+            self.sync_seconds and time.monotonic() - self._last_sync >= self.sync_seconds
+        ):
+            self.sync()
+
+    def sync(self) -> None:
+        try:
+            self._f.flush()
+            os.fsync(self._f.fileno())
+        except Exception:
+            pass
+        self._rows_since_sync = 0
+        self._last_sync = time.monotonic()
+
+
+_CSV_BUFFERING = 1024 * 1024
+_WRITE_BATCH = 64
+_EMBED_BATCH = 64  # số câu hỏi mỗi lượt /api/embed của --semantic-cache
 
 
 def read_prompts_file(prompts_path: str) -> List[str]:
@@ -22,22 +334,158 @@ def read_prompts_file(prompts_path: str) -> List[str]:
     return [line for line in lines if line]
 
 
+def system_message(system_prompt: str) -> Dict[str, str] | None:
+    # Dựng sẵn một lần cho cả lượt chạy rồi truyền vào các hàm _ask_*_fast
+    return {"role": "system", "content": system_prompt} if system_prompt else None
+
+
+def _messages(system_msg: Dict[str, str] | None, question: str) -> Tuple[Dict[str, str], ...]:
+    user_msg = {"role": "user", "content": question}
+    return (system_msg, user_msg) if system_msg is not None else (user_msg,)
+
+
+def _chat_kwargs(
+    model_name: str,
+    system_msg: Dict[str, str] | None,
+    question: str,
+    options: Dict[str, object] | None,
+    format: str,
+) -> Dict[str, object]:
+    # Tham số chung cho mọi lượt chat của các hàm _ask_*_fast
+    return {
+        "model": model_name,
+        "messages": _messages(system_msg, question),
+        "options": options or {},
+        "format": format,
+        "keep_alive": _KEEP_ALIVE,
+    }
+
+
+def _content(response) -> str:
+    return response.get("message", {}).get("content", "").strip()
+
+
 def ask_ollama(
     model_name: str,
     question: str,
     system_prompt: str = "",
     options: Dict[str, object] | None = None,
+    format: str = "",
 ) -> str:
-    messages: List[Dict[str, str]] = []
-    if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
-    messages.append({"role": "user", "content": question})
+    return _ask_ollama_fast(model_name, system_message(system_prompt), question, options, format)
 
-    response = ollama.chat(model=model_name, messages=messages, options=options or {})
-    content = response.get("message", {}).get("content", "").strip()
-    return content
+
+# Các hàm _ask_*_fast cùng một trình tự: tra cache -> chờ token rps -> gọi
+# chat -> lưu cache; chỉ khác cách gọi (đồng bộ, stream, async)
+def _ask_ollama_fast(
+    model_name: str,
+    system_msg: Dict[str, str] | None,
+    question: str,
+    options: Dict[str, object] | None = None,
+    format: str = "",
+) -> str:
+    # format="json": Ollama ràng buộc quá trình decode để luôn ra JSON hợp lệ
+    key, cached = _cache_lookup(model_name, system_msg, question, options, format)
+    if cached is not None:
+        return cached
+    if _BUCKET is not None:
+        _BUCKET.acquire()
+    response = _CLIENT.chat(**_chat_kwargs(model_name, system_msg, question, options, format))
+    return _cache_store(key, _content(response), format)
+
+
+class _JsonScanner:
+    # Theo dõi độ sâu {} / [] qua từng chunk stream (bỏ qua nội dung chuỗi)
+    # để biết khi nào object JSON ngoài cùng đã đóng; feed trả về vị trí ngay
+    # sau dấu đóng trong chunk (0: chưa đóng)
+    def __init__(self) -> None:
+        self.depth = 0
+        self.started = False
+        self.in_str = False
+        self.escape = False
+
+    def feed(self, chunk: str) -> int:
+        for i, ch in enumerate(chunk):
+            if self.in_str:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_str = False
+            elif ch == '"':
+                self.in_str = True
+            elif ch in "{[":
+                self.depth += 1
+                self.started = True
+            elif ch in "}]":
+                self.depth -= 1
+                if self.started and self.depth == 0:
+                    return i + 1
+        return 0
+
+
+def _load_json(raw: str) -> object:
+    # Như _loads, nhưng nếu model viết thêm chữ sau object JSON thì chỉ parse
+    # phần tới dấu đóng ngoài cùng, cho cùng kết quả với đường stream
+    try:
+        return _loads(raw)
+    except Exception:
+        end = _JsonScanner().feed(raw)
+        if not end:
+            raise
+        return _loads(raw[:end])
+
+
+def _ask_ollama_stream_fast(
+    model_name: str,
+    system_msg: Dict[str, str] | None,
+    question: str,
+    options: Dict[str, object] | None = None,
+    format: str = "",
+) -> str:
+    # Đọc câu trả lời dạng stream chỉ để với format="json" dừng ngay khi object
+    # JSON ngoài cùng đóng, không chờ server sinh nốt phần thừa phía sau.
+    # Trả về toàn bộ nội dung một lần như _ask_ollama_fast.
+    key, cached = _cache_lookup(model_name, system_msg, question, options, format)
+    if cached is not None:
+        return cached
+    if _BUCKET is not None:
+        _BUCKET.acquire()
+    scanner = _JsonScanner() if format == "json" else None
+    parts: List[str] = []
+    stream = _CLIENT.chat(**_chat_kwargs(model_name, system_msg, question, options, format), stream=True)
+    try:
+        for chunk in stream:
+            piece = chunk.get("message", {}).get("content", "")
+            end = scanner.feed(piece) if scanner is not None else 0
+            if end:
+                parts.append(piece[:end])
+                break
+            parts.append(piece)
+    finally:
+        stream.close()  # đóng response ngay để trả kết nối về pool
+    return _cache_store(key, "".join(parts).strip(), format)
+
+
+async def _ask_ollama_fast_async(
+    client: "ollama.AsyncClient",
+    model_name: str,
+    system_msg: Dict[str, str] | None,
+    question: str,
+    options: Dict[str, object] | None = None,
+    format: str = "",
+) -> str:
+    key, cached = _cache_lookup(model_name, system_msg, question, options, format)
+    if cached is not None:
+        return cached
+    if _BUCKET is not None:
+        await _BUCKET.acquire_async()
+    response = await client.chat(**_chat_kwargs(model_name, system_msg, question, options, format))
+    return _cache_store(key, _content(response), format)
 
 
+@functools.lru_cache(maxsize=2)
 def build_json_instruction(domain: str) -> str:
     domain_line = (
         "CHỈ trong phạm vi luật giao thông Việt Nam (ưu tiên đường bộ)."
@@ -60,172 +508,238 @@ def build_json_instruction(domain: str) -> str:
     )
 
 
-def _strip_tables(text: str) -> str:
-    # Loại bỏ dấu '|' và tiêu đề bảng nếu còn sót
-    lines = []
-    for raw in text.splitlines():
-        if raw.strip().startswith("|") or "|" in raw:
-            raw = raw.replace("|", " ")
-        lines.append(raw)
-    return "\n".join(lines)
+_ANALYSIS_HINT = (
+    "Trả lời theo cấu trúc:\n"
+    "1) Phân tích hành vi\n2) Căn cứ pháp lý\n3) Mức phạt áp dụng\n4) Tổng hợp."
+)
+
+
+def build_answer_system(system_prompt: str, domain: str, structured: bool) -> str:
+    # Toàn bộ phần bất biến (system prompt + hướng dẫn JSON/cấu trúc) nằm ở
+    # system message, câu hỏi chỉ nằm ở user message: mọi request chung một
+    # prefix dài nên Ollama dùng lại được KV-cache của phần prefix đó
+    if structured:
+        instruction = build_json_instruction(domain)
+    elif system_prompt:
+        instruction = _ANALYSIS_HINT
+    else:
+        return ""
+    return f"{system_prompt}\n{instruction}" if system_prompt else instruction
+
+
+def _strip_tables(lines: Iterator[str]) -> Iterator[str]:
+    # Loại bỏ dấu '|' của bảng nếu còn sót, ngay trên từng dòng khi sinh ra.
+    # splitlines() từng dòng đưa mọi kiểu xuống dòng lẫn trong chuỗi của model
+    # (\r\n, \r, \u2028...) về "\n" như cách render cũ; vì _coerce_payload đã
+    # strip mọi trường nên kết quả giống hệt splitlines() trên cả văn bản.
+    # Dùng str.replace thay vì str.translate: với văn bản tiếng Việt (không
+    # phải ASCII) translate tra dict từng ký tự, chậm hơn nhiều.
+    for line in lines:
+        for piece in line.splitlines():
+            yield piece.replace("|", " ")
+
+
+class Violation(TypedDict):
+    name: str
+    details: str
+
+
+class Citation(TypedDict):
+    law: str
+    article: str
+    clause: str
+
+
+class Penalty(TypedDict):
+    violation: str
+    fine_min_vnd: int
+    fine_max_vnd: int
+    license_suspension_months: int
+
+
+class Payload(TypedDict):
+    question: str
+    violations: List[Violation]
+    citations: List[Citation]
+    penalties: List[Penalty]
+    summary: str
+
+
+def _str(x: object) -> str:
+    return str(x).strip()
+
+
+def _int(x: object) -> int:
+    try:
+        return int(x or 0)  # type: ignore[call-overload]
+    except (TypeError, ValueError):
+        return 0
+
+
+def _dicts(x: object) -> List[Dict[str, object]]:
+    return [item for item in x if isinstance(item, dict)] if isinstance(x, list) else []
+
+
+def _coerce_payload(parsed: object, question: str = "") -> Payload:
+    # Chuẩn hoá kiểu dữ liệu đúng một lần ngay khi parse, để các hàm render
+    # dùng trực tiếp các trường mà không phải str()/strip()/int() lặp lại
+    if not isinstance(parsed, dict):
+        parsed = {"question": question, "summary": str(parsed)}
+    get = parsed.get
+    return {
+        "question": _str(get("question", "")),
+        "violations": [
+            {"name": _str(v.get("name", "")), "details": _str(v.get("details", ""))}
+            for v in _dicts(get("violations"))
+        ],
+        "citations": [
+            {"law": _str(c.get("law", "")), "article": _str(c.get("article", "")), "clause": _str(c.get("clause", ""))}
+            for c in _dicts(get("citations"))
+        ],
+        "penalties": [
+            {
+                "violation": _str(p.get("violation", "")),
+                "fine_min_vnd": _int(p.get("fine_min_vnd", 0)),
+                "fine_max_vnd": _int(p.get("fine_max_vnd", 0)),
+                "license_suspension_months": _int(p.get("license_suspension_months", 0)),
+            }
+            for p in _dicts(get("penalties"))
+        ],
+        "summary": _str(get("summary", "")),
+    }
+
+
+def _vnd(x: int) -> str:
+    return f"{x:,}"
+
 
+def _cite(c: Citation) -> str:
+    # "luật, điều, khoản" bỏ qua phần trống
+    return ", ".join([p for p in (c["law"], c["article"], c["clause"]) if p])
 
-def render_answer_from_json(payload: Dict[str, object], style: str) -> str:
-    lines: List[str] = []
-    question = str(payload.get("question", "")).strip()
+
+def _answer_lines(payload: Payload, style: str) -> Iterator[str]:
+    bullet = "-" if style == "markdown" else "*"
+    question = payload["question"]
     if question:
-        lines.append(f"Câu hỏi: {question}")
-    lines.append("1) Hành vi vi phạm:")
-    violations = payload.get("violations", []) or []
+        yield f"Câu hỏi: {question}"
+    yield "1) Hành vi vi phạm:"
+    violations = payload["violations"]
     if not violations:
-        lines.append("- Không xác định vi phạm hoặc ngoài phạm vi giao thông." if style == "markdown" else "* Không xác định vi phạm hoặc ngoài phạm vi giao thông.")
+        yield f"{bullet} Không xác định vi phạm hoặc ngoài phạm vi giao thông."
     else:
-        for v in violations:  # type: ignore
-            name = str(v.get("name", "")).strip()
-            details = str(v.get("details", "")).strip()
-            bullet = "-" if style == "markdown" else "*"
-            lines.append(f"{bullet} {name}: {details}")
-
-    lines.append("\n2) Căn cứ pháp lý:")
-    citations = payload.get("citations", []) or []
-    if citations:
-        for c in citations:  # type: ignore
-            law = str(c.get("law", "")).strip()
-            article = str(c.get("article", "")).strip()
-            clause = str(c.get("clause", "")).strip()
-            cite = ", ".join([p for p in [law, article, clause] if p])
-            if cite:
-                bullet = "-" if style == "markdown" else "*"
-                lines.append(f"{bullet} {cite}")
-
-    lines.append("\n3) Mức phạt áp dụng:")
-    penalties = payload.get("penalties", []) or []
-    if penalties:
-        for p in penalties:  # type: ignore
-            vio = str(p.get("violation", "")).strip()
-            fmin = p.get("fine_min_vnd", 0)
-            fmax = p.get("fine_max_vnd", 0)
-            months = int(p.get("license_suspension_months", 0) or 0)
-            span = f"{int(fmin):,}–{int(fmax):,} VND" if fmax else f"{int(fmin):,} VND"
-            extra = f", tước GPLX {months} tháng" if months else ""
-            bullet = "-" if style == "markdown" else "*"
-            lines.append(f"{bullet} {vio}: phạt {span}{extra}")
-
-    summary = str(payload.get("summary", "")).strip()
+        for v in violations:
+            yield f"{bullet} {v['name']}: {v['details']}"
+
+    yield "\n2) Căn cứ pháp lý:"
+    for c in payload["citations"]:
+        cite = _cite(c)
+        if cite:
+            yield f"{bullet} {cite}"
+
+    yield "\n3) Mức phạt áp dụng:"
+    for p in payload["penalties"]:
+        fmax = p["fine_max_vnd"]
+        months = p["license_suspension_months"]
+        fmin = _vnd(p["fine_min_vnd"])
+        span = f"{fmin}–{_vnd(fmax)} VND" if fmax else f"{fmin} VND"
+        extra = f", tước GPLX {months} tháng" if months else ""
+        yield f"{bullet} {p['violation']}: phạt {span}{extra}"
+
+    summary = payload["summary"]
     if summary:
-        lines.append("\n4) Tổng hợp:")
-        lines.append(summary)
-
-    final_text = "\n".join(lines)
-    if style != "markdown":
-        final_text = _strip_tables(final_text)
-    return final_text
-
-
-def render_strict_answer(payload: Dict[str, object]) -> str:
-    if not isinstance(payload, dict):
-        payload = {
-            "question": "",
-            "summary": str(payload),
-            "violations": [],
-            "citations": [],
-            "penalties": [],
-        }
-    question = str(payload.get("question", "")).strip()
-    citations = payload.get("citations", []) or []
-    penalties = payload.get("penalties", []) or []
-    violations = payload.get("violations", []) or []
+        yield "\n4) Tổng hợp:"
+        yield summary
+
+
+def render_answer_from_json(payload: Payload, style: str) -> str:
+    if style == "markdown":
+        return "\n".join(_answer_lines(payload, style))
+    return "\n".join(_strip_tables(_answer_lines(payload, style)))
+
+
+def _strict_lines(payload: Payload) -> Iterator[str]:
+    question = payload["question"]
+    citations = payload["citations"]
+    penalties = payload["penalties"]
+    violations = payload["violations"]
 
     # Intro line
     basis_hint = "Luật Giao thông đường bộ Việt Nam"
-    decree_mentions: List[str] = []
-    for c in citations:  # type: ignore
-        law = str(c.get("law", ""))
-        if law:
-            decree_mentions.append(law)
+    decree_mentions = {c["law"] for c in citations if c["law"]}
     if decree_mentions:
-        basis_hint += ", " + ", ".join(sorted(set(decree_mentions)))
+        basis_hint += ", " + ", ".join(sorted(decree_mentions))
 
-    parts: List[str] = []
     if question:
-        parts.append(f"Đối với tình huống: {question}")
-    parts.append(
-        f"Theo {basis_hint}, xử lý như sau:"
-    )
+        yield f"Đối với tình huống: {question}"
+    yield f"Theo {basis_hint}, xử lý như sau:"
 
     # Map penalties by violation name for easy lookup
-    name_to_pen: Dict[str, Dict[str, object]] = {}
-    for p in penalties:  # type: ignore
-        name = str(p.get("violation", "")).strip()
-        if name:
-            name_to_pen[name.lower()] = p
+    name_to_pen: Dict[str, Penalty] = {name: p for p in penalties if (name := p["violation"].lower())}
 
     # Numbered sections
     total_min = 0
     total_max = 0
     max_susp = 0
-    for idx, v in enumerate(violations or [], start=1):  # type: ignore
-        vname = str(v.get("name", "")).strip()
-        vdet = str(v.get("details", "")).strip()
-        parts.append(f"{idx}. {vname}")
-        if vdet:
-            parts.append(vdet)
-        p = name_to_pen.get(vname.lower(), {})
-        fmin = int(p.get("fine_min_vnd", 0) or 0)
-        fmax = int(p.get("fine_max_vnd", 0) or 0)
-        months = int(p.get("license_suspension_months", 0) or 0)
+    pen_get = name_to_pen.get
+    for idx, v in enumerate(violations, start=1):
+        vname = v["name"]
+        yield f"{idx}. {vname}"
+        if v["details"]:
+            yield v["details"]
+        p = pen_get(vname.lower())
+        if p is None:
+            continue
+        fmin = p["fine_min_vnd"]
+        fmax = p["fine_max_vnd"]
+        months = p["license_suspension_months"]
         if fmin or fmax:
-            span = f"{fmin:,} – {fmax:,} đồng" if fmax else f"{fmin:,} đồng"
-            parts.append(f"Mức phạt tiền: từ {span}.")
+            span = f"{_vnd(fmin)} – {_vnd(fmax)} đồng" if fmax else f"{_vnd(fmin)} đồng"
+            yield f"Mức phạt tiền: từ {span}."
             total_min += fmin
             total_max += fmax if fmax else fmin
         if months:
-            parts.append(f"Hình phạt bổ sung: có thể bị tước Giấy phép lái xe {months} tháng.")
+            yield f"Hình phạt bổ sung: có thể bị tước Giấy phép lái xe {months} tháng."
             if months > max_susp:
                 max_susp = months
 
     # If there are general citations, add a concise basis line
     if citations:
-        basis_lines: List[str] = []
-        for c in citations:  # type: ignore
-            law = str(c.get("law", "")).strip()
-            article = str(c.get("article", "")).strip()
-            clause = str(c.get("clause", "")).strip()
-            cite = ", ".join([p for p in [law, article, clause] if p])
-            if cite:
-                basis_lines.append(cite)
+        basis_lines = [cite for cite in map(_cite, citations) if cite]
         if basis_lines:
-            parts.append("Căn cứ: " + "; ".join(basis_lines) + ".")
+            yield "Căn cứ: " + "; ".join(basis_lines) + "."
 
-    summary = str(payload.get("summary", "")).strip()
+    summary = payload["summary"]
     if summary:
-        parts.append(summary)
+        yield summary
 
     # Combined penalty note
     if total_min or total_max or max_susp:
         comb = "Nếu vi phạm đồng thời, tiền phạt được cộng dồn"
         if total_min or total_max:
             if total_min and total_max and total_max >= total_min:
-                comb += f" (tổng khoảng {total_min:,} – {total_max:,} đồng)"
+                comb += f" (tổng khoảng {_vnd(total_min)} – {_vnd(total_max)} đồng)"
             elif total_min:
-                comb += f" (tối thiểu {total_min:,} đồng)"
+                comb += f" (tối thiểu {_vnd(total_min)} đồng)"
         if max_susp:
             comb += f", và có nguy cơ bị tước GPLX tối đa {max_susp} tháng."
         else:
             comb += "."
-        parts.append(comb)
+        yield comb
 
-    text = "\n".join(parts)
-    return _strip_tables(text)
 
+def render_strict_answer(payload: Payload) -> str:
+    return "\n".join(_strip_tables(_strict_lines(payload)))
 
-def synthesize_complex_question(model_name: str, domain: str, options: Dict[str, object] | None) -> str:
+
+@functools.lru_cache(maxsize=2)
+def _synth_system(domain: str) -> str:
     domain_scaffold = (
         "trong PHẠM VI LUẬT GIAO THÔNG VIỆT NAM (đường bộ là chính)"
         if domain == "traffic"
         else "trong phạm vi pháp luật Việt Nam"
     )
-    system_prompt = (
+    return (
         "Bạn là chuyên gia xây dựng dữ liệu hỏi đáp pháp lý. "
         f"Hãy tạo duy nhất 1 câu hỏi tình huống phức tạp {domain_scaffold}. "
         "Câu hỏi phải chứa ÍT NHẤT 2 hành vi vi phạm giao thông trong cùng tình huống, "
@@ -233,12 +747,142 @@ def synthesize_complex_question(model_name: str, domain: str, options: Dict[str,
         "Chỉ TRẢ VỀ CÂU HỎI, không thêm chú thích hay đánh số."
     )
 
-    response = ollama.chat(
-        model=model_name,
-        messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": "Tạo câu hỏi."}],
-        options=options or {},
-    )
-    return response.get("message", {}).get("content", "").strip()
+
+def synthesize_complex_question(model_name: str, domain: str, options: Dict[str, object] | None) -> str:
+    return _ask_ollama_fast(model_name, system_message(_synth_system(domain)), "Tạo câu hỏi.", options)
+
+
+async def question_stream(
+    client: "ollama.AsyncClient",
+    model_name: str,
+    domain: str,
+    count: int,
+    sem: asyncio.Semaphore,
+    prefetch: int = 1,
+    options: Dict[str, object] | None = None,
+) -> AsyncIterator[str]:
+    # Sinh trước tối đa `prefetch` câu hỏi đồng thời và trả ra theo thứ tự
+    # hoàn thành, để câu trả lời bắt đầu ngay trong lúc các câu sau còn đang
+    # được sinh. Mỗi lượt sinh giữ một chỗ trong `sem` như lượt trả lời, nên
+    # tổng số yêu cầu đang chạy không vượt quá --workers.
+    system_msg = system_message(_synth_system(domain))
+
+    async def _one() -> str:
+        async with sem:
+            return await _ask_ollama_fast_async(client, model_name, system_msg, "Tạo câu hỏi.", options)
+
+    pending: set = set()
+    started = 0
+    try:
+        while started < count or pending:
+            while started < count and len(pending) < max(1, prefetch):
+                pending.add(asyncio.ensure_future(_one()))
+                started += 1
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    q = task.result()
+                except Exception as e:
+                    print(f"[Lỗi sinh câu hỏi: {e}]")
+                    continue
+                if q:
+                    yield q
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+@dataclass(frozen=True)
+class GenCfg:
+    # Cấu hình trả lời một câu hỏi; picklable để gửi sang ProcessPoolExecutor
+    model: str
+    system_prompt: str
+    options: Dict[str, object]
+    enforce_structured: bool
+    retries: int
+    domain: str
+    style: str
+
+    @functools.cached_property
+    def answer_system(self) -> str:
+        return build_answer_system(self.system_prompt, self.domain, self.enforce_structured)
+
+    @functools.cached_property
+    def system_msg(self) -> Dict[str, str] | None:
+        return system_message(self.answer_system)
+
+
+def _parse_payload(q: str, raw: str, last_attempt: bool) -> Payload | None:
+    # Trả về None khi JSON hỏng và vẫn còn lượt retry
+    try:
+        parsed = _load_json(raw)
+    except Exception:
+        if not last_attempt:
+            return None
+        parsed = {"question": q, "summary": raw}
+    return _coerce_payload(parsed, q)
+
+
+def _render(payload: Payload, style: str) -> str:
+    if style == "strict":
+        return render_strict_answer(payload)
+    return render_answer_from_json(payload, style)
+
+
+@dataclass
+class Answered:
+    # Kết quả _answer: câu trả lời đã render, kèm payload chưa render (chế độ
+    # --structured) để đưa vào SemanticCache
+    text: str
+    payload: Payload | None = None
+    # Số hit/miss cache của lượt này: cache trong tiến trình con là bản riêng,
+    # tiến trình cha cộng dồn lại để in thống kê
+    cache_hits: int = 0
+    cache_misses: int = 0
+    # Số lượt thực sự gọi model (không tính lượt trúng cache), để tiến trình
+    # cha tính đúng --rps cho chế độ process
+    calls: int = 0
+
+
+def _relabel(payload: Payload, q: str) -> Payload:
+    # Payload lấy từ SemanticCache thuộc về một câu hỏi khác: dùng bản sao
+    # mang câu hỏi hiện tại để dòng CSV không bị gán nhầm câu hỏi
+    return {**payload, "question": q}
+
+
+def _answer(cfg: GenCfg, q: str) -> Answered:
+    # Trả lời trọn vẹn một câu hỏi (gọi model + render); hàm top-level nên
+    # chạy được trong tiến trình con của ProcessPoolExecutor
+    before = dict(_CACHE.stats) if _CACHE is not None else {}
+    attempt = 0
+    try:
+        if cfg.enforce_structured:
+            payload = None
+            while payload is None:
+                attempt += 1
+                raw = _ask_ollama_fast(cfg.model, cfg.system_msg, q, cfg.options, "json")
+                payload = _parse_payload(q, raw, attempt > max(cfg.retries, 0))
+            answered = Answered(_render(payload, cfg.style), payload)
+        else:
+            attempt += 1
+            answered = Answered(_ask_ollama_fast(cfg.model, cfg.system_msg, q, cfg.options))
+    except Exception as e:
+        answered = Answered(f"{_ERROR_PREFIX}: {e}]")
+    answered.calls = attempt
+    if _CACHE is not None:
+        answered.cache_hits = _CACHE.stats["hits"] - before["hits"]
+        answered.cache_misses = _CACHE.stats["misses"] - before["misses"]
+        answered.calls -= answered.cache_hits
+    return answered
+
+
+def _init_worker(cache_path: str) -> None:
+    # --rps do tiến trình cha tính cho cả nhóm (xem _gen) nên tiến trình con
+    # không giới hạn riêng
+    configure_client(1)
+    configure_rate_limit(0, 1)
+    if cache_path:
+        open_cache(cache_path)
 
 
 def generate_dataset(
@@ -255,81 +899,163 @@ def generate_dataset(
     domain: str = "traffic",
     style: str = "plain",
     workers: int = 1,
+    semantic_cache: SemanticCache | None = None,
+    auto: int = 0,
+    worker_mode: str = "thread",
 ) -> None:
-    def generate_answer_for_question(q: str) -> str:
+    # auto > 0: bỏ qua `questions`, tự sinh `auto` câu hỏi song song với việc trả lời.
+    # worker_mode="process": mỗi câu hỏi được gọi + render trong ProcessPoolExecutor
+    cfg = GenCfg(model_name, system_prompt, dict(options or {}), enforce_structured, retries, domain, style)
+    warmup(model_name, cfg.answer_system, options)
+
+    async def _gen(
+        q: str,
+        emb: "np.ndarray | None",
+        sem: asyncio.Semaphore,
+        client: "ollama.AsyncClient",
+        q_raw: asyncio.Queue,
+        pool: ProcessPoolExecutor | None,
+    ) -> None:
+        # Producer: chỉ lo phần I/O mạng, đẩy (câu hỏi, kết quả) vào hàng đợi.
+        # Kết quả là payload dict cần render hoặc văn bản trả lời cuối cùng.
+        # Chỉ payload mới vào SemanticCache: câu trả lời tự do hay nhắc lại
+        # nguyên văn câu hỏi cũ nên không dùng lại được cho câu hỏi khác.
+        result: Payload | str | None = None
+        try:
+            async with sem:
+                if emb is not None:
+                    hit = semantic_cache.match(emb)  # type: ignore[union-attr]
+                    if hit is not None:
+                        result = _relabel(hit, q)
+                        emb = None
+                if result is None and pool is not None:
+                    # Mọi token --rps lấy ở tiến trình cha, chung một bucket với
+                    # lượt sinh câu hỏi: lấy trước 1 token cho lượt gọi, trả lại
+                    # nếu trúng cache, lấy bù cho mỗi lượt retry
+                    if _BUCKET is not None:
+                        await _BUCKET.acquire_async()
+                    answered = await asyncio.get_running_loop().run_in_executor(pool, _answer, cfg, q)
+                    if _BUCKET is not None:
+                        if answered.calls == 0:
+                            _BUCKET.release()
+                        for _ in range(answered.calls - 1):
+                            await _BUCKET.acquire_async()
+                    result = answered.text
+                    if _CACHE is not None:
+                        _CACHE.stats["hits"] += answered.cache_hits
+                        _CACHE.stats["misses"] += answered.cache_misses
+                    if emb is not None and answered.payload is not None:
+                        semantic_cache.add(emb, answered.payload)  # type: ignore[union-attr]
+                    emb = None
+                elif result is None and enforce_structured:
+                    attempt = 0
+                    while result is None:
+                        attempt += 1
+                        raw = await _ask_ollama_fast_async(
+                            client, model_name, cfg.system_msg, q, cfg.options, "json"
+                        )
+                        result = _parse_payload(q, raw, attempt > max(retries, 0))
+                elif result is None:
+                    result = await _ask_ollama_fast_async(client, model_name, cfg.system_msg, q, cfg.options)
+                if emb is not None and isinstance(result, dict):
+                    semantic_cache.add(emb, result)  # type: ignore[union-attr]
+        except Exception as e:
+            result = f"{_ERROR_PREFIX}: {e}]"
+        await q_raw.put((q, result))
+
+    async def _write(q_raw: asyncio.Queue, sink: CsvSink) -> None:
+        # Consumer duy nhất: render (CPU) và ghi CSV, không phải chờ mạng và
+        # là nơi duy nhất chạm vào file nên không cần lock. Các dòng được gom
+        # lại và ghi bằng writerows khi đủ lô hoặc khi hàng đợi tạm rỗng.
+        done = 0
+        batch: List[List[str]] = []
+
+        def flush() -> None:
+            nonlocal done
+            sink.writerows(batch)
+            done += len(batch)
+            batch.clear()
+            print(f"{done}/{total} ✓")
+
         try:
-            if enforce_structured:
-                attempt = 0
-                payload = None
-                json_instruction = build_json_instruction(domain)
-                while attempt <= max(retries, 0):
-                    attempt += 1
-                    raw = ask_ollama(
-                        model_name,
-                        f"{json_instruction}\n\nQ: {q}",
-                        system_prompt,
-                        options,
-                    )
+            while True:
+                item = await q_raw.get()
+                if item is None:
+                    break
+                q, result = item
+                if isinstance(result, dict):
                     try:
-                        parsed = json.loads(raw)
-                        payload = parsed if isinstance(parsed, dict) else {
-                            "question": q,
-                            "summary": str(parsed),
-                            "violations": [],
-                            "citations": [],
-                            "penalties": [],
-                        }
-                        break
-                    except Exception:
-                        if attempt > max(retries, 0):
-                            payload = {"question": q, "summary": raw, "violations": [], "citations": [], "penalties": []}
-                            break
-                if style == "strict":
-                    return render_strict_answer(payload)  # type: ignore
-                return render_answer_from_json(payload, style)  # type: ignore
+                        result = _render(result, style)
+                    except Exception as e:
+                        result = f"{_ERROR_PREFIX}: {e}]"
+                batch.append([q, result])
+                if len(batch) >= _WRITE_BATCH or q_raw.empty():
+                    flush()
+        finally:
+            if batch:
+                flush()
+
+    total = auto if auto > 0 else len(questions)
+
+    async def run(sink: CsvSink) -> None:
+        # Một event loop duy nhất, Semaphore giới hạn số yêu cầu đồng thời
+        sem = asyncio.Semaphore(max(1, workers))
+        q_raw: asyncio.Queue = asyncio.Queue(maxsize=max(1, workers) * 4)
+        client = _new_async_client()
+        pool = None
+        if worker_mode == "process":
+            # Mỗi tiến trình con có client và cache riêng
+            pool = ProcessPoolExecutor(
+                max_workers=max(1, workers),
+                initializer=_init_worker,
+                initargs=(_CACHE.path if _CACHE is not None else "",),
+            )
+
+        async def _produce_all() -> None:
+            tasks = []
+
+            async def _spawn(batch: List[str]) -> None:
+                # Embed cả lô trong một lượt /api/embed (async, không chặn event
+                # loop) rồi giao ngay cho _gen; lô sau được embed trong lúc lô
+                # trước đang được trả lời
+                if semantic_cache is not None:
+                    embs = await semantic_cache.embed_many_async(client, batch)
+                else:
+                    embs = [None] * len(batch)
+                tasks.extend(asyncio.ensure_future(_gen(q, e, sem, client, q_raw, pool)) for q, e in zip(batch, embs))
+
+            if auto > 0:
+                # Câu hỏi tự sinh về theo từng đợt tối đa `workers` câu; gom
+                # đủ một đợt rồi mới embed (không cần gom khi tắt semantic cache)
+                chunk = max(1, workers) if semantic_cache is not None else 1
+                batch: List[str] = []
+                async for q in question_stream(client, model_name, domain, auto, sem, max(1, workers)):
+                    batch.append(q)
+                    if len(batch) >= chunk:
+                        await _spawn(batch)
+                        batch = []
+                if batch:
+                    await _spawn(batch)
             else:
-                analysis_hint = (
-                    "Trả lời theo cấu trúc:\n"
-                    "1) Phân tích hành vi\n2) Căn cứ pháp lý\n3) Mức phạt áp dụng\n4) Tổng hợp."
-                )
-                full_prompt = q if not system_prompt else f"{q}\n\n{analysis_hint}"
-                return ask_ollama(model_name, full_prompt, system_prompt, options)
-        except Exception as e:
-            return f"[Lỗi gọi mô hình: {e}]"
+                for start in range(0, len(questions), _EMBED_BATCH):
+                    await _spawn(questions[start:start + _EMBED_BATCH])
+            await asyncio.gather(*tasks)
+            await q_raw.put(None)
+
+        try:
+            await asyncio.gather(_write(q_raw, sink), _produce_all())
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
     os.makedirs(os.path.dirname(output_csv) or ".", exist_ok=True)
-    with open(output_csv, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow(["question", "answer"])  # header
+    with open(output_csv, "w", newline="", encoding="utf-8", buffering=_CSV_BUFFERING) as f:
+        sink = CsvSink(f)
+        sink.writerow(["question", "answer"])  # header
         try:
-            f.flush()
-            os.fsync(f.fileno())
-        except Exception:
-            pass
-        if workers and workers > 1:
-            lock = threading.Lock()
-            with ThreadPoolExecutor(max_workers=workers) as pool:
-                future_to_q = {pool.submit(generate_answer_for_question, q): q for q in questions}
-                done = 0
-                for future in as_completed(future_to_q):
-                    q = future_to_q[future]
-                    ans = future.result()
-                    with lock:
-                        writer.writerow([q, ans])
-                        try:
-                            f.flush(); os.fsync(f.fileno())
-                        except Exception:
-                            pass
-                    done += 1
-                    print(f"{done}/{len(questions)} ✓")
-        else:
-            for idx, q in enumerate(questions, start=1):
-                ans = generate_answer_for_question(q)
-                writer.writerow([q, ans])
-                try:
-                    f.flush(); os.fsync(f.fileno())
-                except Exception:
-                    pass
-                print(f"{idx}/{len(questions)} ✓")
+            asyncio.run(run(sink))
+        finally:
+            sink.sync()
 
 
 def main() -> None:
@@ -378,8 +1104,8 @@ def main() -> None:
     parser.add_argument(
         "--retries",
         type=int,
-        default=1,
-        help="Số lần retry khi JSON không hợp lệ",
+        default=0,
+        help="Số lần retry khi JSON không hợp lệ (hiếm gặp nhờ format=json, chủ yếu khi câu trả lời bị cắt)",
     )
     parser.add_argument(
         "--style",
@@ -393,6 +1119,18 @@ def main() -> None:
         default=1,
         help="Số luồng gọi mô hình song song (đề xuất 2-4). 1 = tuần tự",
     )
+    parser.add_argument(
+        "--worker-mode",
+        choices=["thread", "process"],
+        default="thread",
+        help="thread: asyncio một tiến trình; process: gọi + render song song trong N tiến trình",
+    )
+    parser.add_argument(
+        "--rps",
+        type=float,
+        default=0.0,
+        help="Giới hạn số yêu cầu/giây gửi tới Ollama (0: không giới hạn)",
+    )
     parser.add_argument(
         "--infinite",
         action="store_true",
@@ -410,16 +1148,29 @@ def main() -> None:
     parser.add_argument("--top-p", type=float, default=0.9, help="Nucleus sampling (0-1)")
     parser.add_argument("--repeat-penalty", type=float, default=1.1, help="Phạt lặp lại")
     parser.add_argument("--seed", type=int, default=0, help="Seed tái lập kết quả (0: ngẫu nhiên)")
+    parser.add_argument(
+        "--cache-db",
+        default="cache.db",
+        help="File SQLite cache câu trả lời khi temperature=0 hoặc có --seed ('' để tắt)",
+    )
+    parser.add_argument(
+        "--semantic-cache",
+        action="store_true",
+        help="Dùng lại câu trả lời cho câu hỏi gần trùng nghĩa (chỉ với --structured; cần numpy + model embedding)",
+    )
+    parser.add_argument("--embed-model", default="nomic-embed-text", help="Model embedding cho --semantic-cache")
+    parser.add_argument(
+        "--semantic-threshold", type=float, default=0.92, help="Ngưỡng cosine để coi hai câu hỏi là trùng"
+    )
 
     args = parser.parse_args()
+    configure_client(args.workers)
+    configure_rate_limit(args.rps, max(1, args.workers))
 
     if args.infinite:
         questions = []
     elif args.auto > 0:
-        questions = [
-            synthesize_complex_question(args.model, args.domain, None)
-            for _ in range(args.auto)
-        ]
+        questions = []  # sinh dần trong generate_dataset
     else:
         questions = read_prompts_file(args.questions)
         if not questions:
@@ -447,7 +1198,7 @@ def main() -> None:
             )
 
     print(f"Model: {args.model}")
-    print(f"Số câu hỏi: {len(questions)}")
+    print(f"Số câu hỏi: {args.auto if args.auto > 0 and not args.infinite else len(questions)}")
     print(f"Xuất: {out_path}")
     gen_options: Dict[str, object] = {
         "num_ctx": args.num_ctx,
@@ -457,60 +1208,52 @@ def main() -> None:
     }
     if args.seed:
         gen_options["seed"] = args.seed
+    cache = open_cache(args.cache_db) if args.cache_db and _is_deterministic(gen_options) else None
+    if args.semantic_cache and not args.structured:
+        print("--semantic-cache chỉ dùng được với --structured, bỏ qua.")
+    semantic = (
+        SemanticCache(args.embed_model, args.semantic_threshold)
+        if args.semantic_cache and args.structured
+        else None
+    )
 
     if args.infinite:
-        import time
         # Stream mode: keep generating until Ctrl+C
         counter = 0
+        answer_system = build_answer_system(system_prompt, args.domain, args.structured)
+        # Dựng system message một lần cho cả vòng lặp; mỗi lượt chỉ đổi câu hỏi
+        sys_msg = system_message(answer_system)
+        warmup(args.model, answer_system, gen_options)
         try:
-            with open(out_path, "a", newline="", encoding="utf-8") as f:
-                writer = csv.writer(f)
+            with open(out_path, "a", newline="", encoding="utf-8", buffering=_CSV_BUFFERING) as f:
+                # Chạy vô hạn: fsync theo thời gian (mỗi 5 giây) thay vì theo số dòng
+                sink = CsvSink(f, sync_rows=0, sync_seconds=5.0)
                 # Write header if file is empty
                 if f.tell() == 0:
-                    writer.writerow(["question", "answer"])
-                while True:
-                    q = synthesize_complex_question(args.model, args.domain, None)
-                    # Reuse the same machinery to produce the answer
-                    gen_list = [q]
-                    tmp_out = out_path  # not used here
-                    # Compute one answer synchronously for stability
-                    def _one(qs: List[str]) -> str:
-                        return ask_ollama(
-                            args.model,
-                            f"{build_json_instruction(args.domain)}\n\nQ: {qs[0]}",
-                            system_prompt,
-                            gen_options,
-                        )
-                    # Structured rendering path
-                    if args.structured:
-                        raw = _one(gen_list)
-                        try:
-                            parsed = json.loads(raw)
-                            payload = parsed if isinstance(parsed, dict) else {
-                                "question": q,
-                                "summary": str(parsed),
-                                "violations": [],
-                                "citations": [],
-                                "penalties": [],
-                            }
-                        except Exception:
-                            payload = {"question": q, "summary": raw, "violations": [], "citations": [], "penalties": []}
-                        ans = render_strict_answer(payload) if args.style == "strict" else render_answer_from_json(payload, args.style)
-                    else:
-                        analysis_hint = (
-                            "Trả lời theo cấu trúc:\n1) Phân tích hành vi\n2) Căn cứ pháp lý\n3) Mức phạt áp dụng\n4) Tổng hợp."
-                        )
-                        ans = ask_ollama(args.model, f"{q}\n\n{analysis_hint}", system_prompt, gen_options)
+                    sink.writerow(["question", "answer"])
+                try:
+                    while True:
+                        q = synthesize_complex_question(args.model, args.domain, None)
+                        if args.structured:
+                            emb, payload = semantic.lookup_many([q])[0] if semantic is not None else (None, None)
+                            if payload is not None:
+                                payload = _relabel(payload, q)
+                            else:
+                                raw = _ask_ollama_stream_fast(args.model, sys_msg, q, gen_options, "json")
+                                payload = _parse_payload(q, raw, True)
+                                if emb is not None:
+                                    semantic.add(emb, payload)  # type: ignore[union-attr, arg-type]
+                            ans = _render(payload, args.style)  # type: ignore[arg-type]
+                        else:
+                            ans = _ask_ollama_fast(args.model, sys_msg, q, gen_options)
 
-                    writer.writerow([q, ans])
-                    try:
-                        f.flush(); os.fsync(f.fileno())
-                    except Exception:
-                        pass
-                    counter += 1
-                    print(f"{counter} ✓")
-                    if args.sleep > 0:
-                        time.sleep(args.sleep)
+                        sink.writerow([q, ans])
+                        counter += 1
+                        print(f"{counter} ✓")
+                        if args.sleep > 0:
+                            sleep_warm(args.sleep, args.model, answer_system, gen_options)
+                finally:
+                    sink.sync()
         except KeyboardInterrupt:
             print("Đã dừng theo yêu cầu (Ctrl+C).")
     else:
@@ -525,7 +1268,15 @@ def main() -> None:
             domain=args.domain,
             style=args.style,
             workers=max(1, args.workers),
+            semantic_cache=semantic,
+            auto=args.auto,
+            worker_mode=args.worker_mode,
         )
+    if semantic is not None:
+        print(f"Semantic cache: {semantic.stats['hits']} hit / {semantic.stats['misses']} miss")
+    if cache is not None:
+        print(f"Cache: {cache.stats['hits']} hit / {cache.stats['misses']} miss")
+        cache.close()
     print("Hoàn tất.")
 
 